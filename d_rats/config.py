@@ -55,6 +55,9 @@ from six.moves import range
 
 BAUD_RATES = ["1200", "2400", "4800", "9600", "19200", "38400", "115200"]
 
+# Decoded ship images by path, as (mtime, pixbuf); see ship_img()
+_SHIP_IMG_CACHE = {}
+
 #these settings are used to popoulate the config when D-Rats is executed the first time
 _DEF_USER = {
     "name" : "A. Mateur",
@@ -1947,8 +1950,22 @@ class DratsConfig(six.moves.configparser.ConfigParser):
         return os.path.join(self.platform.source_dir(), name)
 
     def ship_img(self, name):
+        # Toolbar and menu icons are loaded again every time a toolbar or
+        # form window is built, so decode each file once and reuse it
+        # for as long as it is unchanged on disk.
         path = self.ship_obj_fn(os.path.join("images", name))
-        return gtk.gdk.pixbuf_new_from_file(path)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            mtime = None
+
+        cached = _SHIP_IMG_CACHE.get(path)
+        if cached and mtime is not None and cached[0] == mtime:
+            return cached[1]
+
+        pixbuf = gtk.gdk.pixbuf_new_from_file(path)
+        _SHIP_IMG_CACHE[path] = (mtime, pixbuf)
+        return pixbuf
 
 
 def main():
@@ -31,6 +31,7 @@ import shutil
 import tempfile
 import threading
 import copy
+import collections
 
 import gtk
 import gobject
@@ -61,6 +62,7 @@ from . import debug
 
 ##############
 from .ui.main_common import ask_for_confirmation
+from . import gps
 from .gps import GPSPosition, distance, value_with_units, DPRS_TO_APRS
 from six.moves import range
 
@@ -68,6 +70,10 @@ CROSSHAIR = "+"
 
 COLORS = ["red", "green", "cornflower blue", "pink", "orange", "grey"]
 
+# Tile edges by (zoom, x, y), kept across map reloads; see tile_edges()
+TILE_EDGES_CACHE_SIZE = 4096
+_TILE_EDGES = collections.OrderedDict()
+
 #set the map location
 BASE_DIR = None
 MAP_TYPE = None
@@ -241,13 +247,31 @@ def num2deg(xtile, ytile, zoom):
 
 class MapTile(object):
     #this class downloads the map tiles
+
+    # A full map is width * height of these, recreated on every reload
+    __slots__ = ("_edges", "zoom", "x", "y", "lat", "lon", "dir")
+
     def path_els(self):
         return deg2num(self.lat, self.lon, self.zoom)
 
     def tile_edges(self):
-        n, w = num2deg(self.x, self.y, self.zoom)
-        s, e = num2deg(self.x+1, self.y+1, self.zoom)
-        return (s, w, n, e)
+        # The edges only depend on x, y and zoom, so work them out once.
+        # Tiles are recreated on every reload and recentering mostly
+        # revisits the same tiles, so also keep them in a small LRU.
+        if self._edges is None:
+            key = (self.zoom, self.x, self.y)
+            try:
+                # Popped and re-added below to mark it recently used
+                edges = _TILE_EDGES.pop(key)
+            except KeyError:
+                n, w = num2deg(self.x, self.y, self.zoom)
+                s, e = num2deg(self.x+1, self.y+1, self.zoom)
+                edges = (s, w, n, e)
+                if len(_TILE_EDGES) >= TILE_EDGES_CACHE_SIZE:
+                    _TILE_EDGES.popitem(last=False)
+            _TILE_EDGES[key] = edges
+            self._edges = edges
+        return self._edges
 
     def lat_range(self):
         s, w, n, e = self.tile_edges()
@@ -325,8 +349,7 @@ class MapTile(object):
         (lat, lon) = point
 
         # FIXME for non-western!
-        (lat_max, lat_min) = self.lat_range()
-        (lon_min, lon_max) = self.lon_range()
+        (lat_min, lon_min, lat_max, lon_max) = self.tile_edges()
 
         lat_match = (lat < lat_max and lat > lat_min)
         lon_match = (lon < lon_max and lon > lon_min)
@@ -335,6 +358,7 @@ class MapTile(object):
 
     def __init__(self, lat, lon, zoom):
         
+        self._edges = None
         self.zoom = zoom
         if isinstance(lat, int) and isinstance(lon, int):
             self.x = lat
@@ -412,26 +436,49 @@ class MapWidget(gtk.DrawingArea):
         self.window.draw_lines(gc, [(x, y-5), (x, y+5)])
         self.window.draw_lines(gc, [(x-5, y), (x+5, y)])
 
-    def latlon2xy(self, lat, lon):
-        y = 1- ((lat - self.lat_min) / (self.lat_max - self.lat_min))
-        x = 1- ((lon - self.lon_min) / (self.lon_max - self.lon_min))
+    def _update_transform(self):
+        # latlon2xy() and xy2latlon() are linear in each coordinate, so
+        # fold the bounds, map size and fudge into a slope and an offset
+        # whenever one of them changes instead of on every call.
+        pix_w = self._pix_w
+        pix_h = self._pix_h
+        lat_span = self.lat_max - self.lat_min
+        lon_span = self.lon_max - self.lon_min
+
+        self._inv_x_a = -float(lon_span) / pix_w
+        self._inv_x_b = self.lon_min + lon_span - \
+            (self._inv_x_a * self.lng_fudge)
+        self._inv_y_a = -float(lat_span) / pix_h
+        self._inv_y_b = self.lat_min + lat_span - \
+            (self._inv_y_a * self.lat_fudge)
+
+        if lat_span and lon_span:
+            self._x_a = -float(pix_w) / lon_span
+            self._x_b = pix_w - (self._x_a * self.lon_min) + self.lng_fudge
+            self._y_a = -float(pix_h) / lat_span
+            self._y_b = pix_h - (self._y_a * self.lat_min) + self.lat_fudge
+        else:
+            # No bounds yet, latlon2xy() can't place anything
+            self._x_a = self._x_b = self._y_a = self._y_b = None
 
-        x *= (self.tilesize * self.width)
-        y *= (self.tilesize * self.height)
+    def latlon2xy(self, lat, lon):
+        if self._x_a is None:
+            raise ZeroDivisionError("Map bounds not calculated")
 
-        y += self.lat_fudge
-        x += self.lng_fudge
-        return (x, y)
+        return (self._x_a * lon + self._x_b, self._y_a * lat + self._y_b)
 
-    def xy2latlon(self, x, y):
-        y -= self.lat_fudge
-        x -= self.lng_fudge
+    def latlons2xy(self, points):
+        # Batch version of latlon2xy() for the per-redraw marker loops,
+        # with the transform looked up once instead of once per point
+        if self._x_a is None:
+            raise ZeroDivisionError("Map bounds not calculated")
 
-        lon = 1 - (float(x) / (self.tilesize * self.width))
-        lat = 1 - (float(y) / (self.tilesize * self.height))
+        x_a, x_b, y_a, y_b = self._x_a, self._x_b, self._y_a, self._y_b
+        return [(x_a * lon + x_b, y_a * lat + y_b) for (lat, lon) in points]
 
-        lat = (lat * (self.lat_max - self.lat_min)) + self.lat_min
-        lon = (lon * (self.lon_max - self.lon_min)) + self.lon_min
+    def xy2latlon(self, x, y):
+        lat = self._inv_y_a * y + self._inv_y_b
+        lon = self._inv_x_a * x + self._inv_x_b
 
         return lat, lon 
     
@@ -450,6 +497,9 @@ class MapWidget(gtk.DrawingArea):
         except ZeroDivisionError:
             return
 
+        self.draw_marker_xy(label, x, y, img, color)
+
+    def draw_marker_xy(self, label, x, y, img=None, color="yellow"):
         if label == CROSSHAIR:
             self.draw_cross_marker_at(x, y)
         else:
@@ -461,12 +511,14 @@ class MapWidget(gtk.DrawingArea):
         if len(self.map_tiles) == 0:
             self.load_tiles()
 
+        # Only copy back the part of the pixmap that was exposed
         gc = self.get_style().black_gc
+        rect = event.area
         self.window.draw_drawable(gc,
                                   self.pixmap,
-                                  0, 0,
-                                  0, 0,
-                                  -1, -1)
+                                  rect.x, rect.y,
+                                  rect.x, rect.y,
+                                  rect.width, rect.height)
         self.emit("redraw-markers")
 
     def calculate_bounds(self):
@@ -497,11 +549,13 @@ class MapWidget(gtk.DrawingArea):
 
         self.lng_fudge = 0
         self.lat_fudge = 0
+        self._update_transform()
         
         s, w, n, e = center.tile_edges()
         x, y = self.latlon2xy(n, w)
         self.lng_fudge = ((self.width / 2) * self.tilesize) - x  
         self.lat_fudge = ((self.height / 2) * self.tilesize) - y
+        self._update_transform()
         
     def broken_tile(self):
         if self.__broken_tile:
@@ -546,6 +600,24 @@ class MapWidget(gtk.DrawingArea):
 
         return pb
 
+    def load_tile_pixbuf(self, path):
+        # Recentering and zooming back and forth mostly redraw tiles that
+        # were just on screen, so keep recently decoded ones around.  A
+        # tile fetched again after expiring has a new mtime and reloads.
+        mtime = os.stat(path).st_mtime
+        try:
+            (cached_mtime, pb) = self._tile_pixbufs.pop(path)
+        except KeyError:
+            cached_mtime = pb = None
+
+        if cached_mtime != mtime:
+            pb = gtk.gdk.pixbuf_new_from_file(path)
+            if len(self._tile_pixbufs) >= self._tile_pixbufs_max:
+                self._tile_pixbufs.popitem(last=False)
+
+        self._tile_pixbufs[path] = (mtime, pb)
+        return pb
+
     def draw_tile(self, path, x, y, ctx=None):
         if ctx and ctx.zoom != self.zoom:
             # Zoom level has changed, so don't do anything
@@ -554,7 +626,7 @@ class MapWidget(gtk.DrawingArea):
         gc = self.pixmap.new_gc()
         if path:
             try:
-                pb = gtk.gdk.pixbuf_new_from_file(path)
+                pb = self.load_tile_pixbuf(path)
             except Exception as e:
                 #this is the case  when some jpg tile file cannot be loaded - typically this was due to html content 
                 # saved as jpg (due to an un trapped http error), or due to really corrupted jpg 
@@ -582,7 +654,7 @@ class MapWidget(gtk.DrawingArea):
                 self.status(frac, _("Loaded") + " %.0f%%" % (frac * 100.0))
 
         self.pixmap.draw_pixbuf(gc, pb, 0, 0, x, y, -1, -1)
-        self.queue_draw()
+        self.queue_draw_area(x, y, pb.get_width(), pb.get_height())
 
     @utils.run_gtk_locked
     def draw_tile_locked(self, *args):
@@ -590,6 +662,7 @@ class MapWidget(gtk.DrawingArea):
 
     def load_tiles(self):
         self.map_tiles = []
+        self._tile_bounds = []
         ctx = LoadContext()
         ctx.loaded_tiles = 0
         ctx.total_tiles = self.width * self.height
@@ -606,13 +679,16 @@ class MapWidget(gtk.DrawingArea):
             # Window is not loaded, thus can't load tiles
             return
 
-        try:
-            self.pixmap = gtk.gdk.Pixmap(self.window,
-                                         self.width * self.tilesize,
-                                         self.height * self.tilesize)
-        except Exception as e:
-            # Window is not loaded, thus can't load tiles
-            return
+        # The backing pixmap is always the full map size and every tile
+        # slot gets redrawn below, so keep it across reloads rather than
+        # allocating a new one each time the map is recentered or zoomed
+        if self.pixmap is None:
+            try:
+                self.pixmap = gtk.gdk.Pixmap(self.window,
+                                             self._pix_w, self._pix_h)
+            except Exception as e:
+                # Window is not loaded, thus can't load tiles
+                return
 
         gc = self.pixmap.new_gc()
 
@@ -636,6 +712,9 @@ class MapWidget(gtk.DrawingArea):
                                         self.tilesize * j,
                                         ctx)
                 self.map_tiles.append(tile)
+                # Keep the edges of each tile around so point_is_visible()
+                # doesn't have to recompute them for every point
+                self._tile_bounds.append(tile.lat_range() + tile.lon_range())
                 count += 1
 
         self.calculate_bounds()
@@ -646,8 +725,8 @@ class MapWidget(gtk.DrawingArea):
             x = 0
             y = 0
             bounds = (0,0,-1,-1)
-            width = self.tilesize * self.width
-            height = self.tilesize * self.height
+            width = self._pix_w
+            height = self._pix_h
         else:
             x = bounds[0]
             y = bounds[1]
@@ -663,6 +742,8 @@ class MapWidget(gtk.DrawingArea):
         gtk.DrawingArea.__init__(self)
 
         self.__broken_tile = None
+        self.pixmap = None
+        self._tile_pixbufs = collections.OrderedDict()
 
         self.height = height
         self.width = width
@@ -671,6 +752,13 @@ class MapWidget(gtk.DrawingArea):
         self.tilesize = tilesize
         self.status = status
 
+        # The map geometry is fixed for the life of the widget
+        self._pix_w = self.tilesize * self.width
+        self._pix_h = self.tilesize * self.height
+
+        # Enough decoded tiles for the current map and the previous one
+        self._tile_pixbufs_max = 2 * self.width * self.height
+
         self.lat = 0
         self.lon = 0
         self.zoom = 1
@@ -679,29 +767,48 @@ class MapWidget(gtk.DrawingArea):
         self.lon_max = self.lon_min = 0
         self.lng_fudge = 0
         self.lat_fudge = 0
+        self._update_transform()
 
         self.map_tiles = []
+        self._tile_bounds = []
+        self._scale_cache = (None, None)
+        self._redraw_pending = False
 
-        self.set_size_request(self.tilesize * self.width,
-                              self.tilesize * self.height)
+        self.set_size_request(self._pix_w, self._pix_h)
         self.connect("expose-event", self.expose)
 
     def set_center(self, lat, lon):
         self.lat = lat
         self.lon = lon
         self.map_tiles = []
-        self.queue_draw()
+        self._tile_bounds = []
+        self.schedule_redraw()
 
     def get_center(self):
         return (self.lat, self.lon)
 
+    def schedule_redraw(self):
+        # Marker updates arrive in bursts (a whole source reloading, new
+        # tiles making every point re-check its visibility), so collapse
+        # them into a single queue_draw() from the main loop
+        if not self._redraw_pending:
+            self._redraw_pending = True
+            gobject.idle_add(self._do_redraw,
+                             priority=gobject.PRIORITY_HIGH_IDLE)
+
+    def _do_redraw(self):
+        self._redraw_pending = False
+        self.queue_draw()
+        return False
+
     def set_zoom(self, zoom):
         if zoom > 18 or zoom == 3:
             return
 
         self.zoom = zoom
         self.map_tiles = []
-        self.queue_draw()
+        self._tile_bounds = []
+        self.schedule_redraw()
 
     def get_zoom(self):
         return self.zoom
@@ -714,14 +821,6 @@ class MapWidget(gtk.DrawingArea):
         #rect = gtk.gdk.Rectangle(x-pixels,y-shift-tick,x,y)
         #self.window.invalidate_rect(rect, True)
 
-        (lat_a, lon_a) = self.xy2latlon(self.tilesize, self.tilesize)
-        (lat_b, lon_b) = self.xy2latlon(self.tilesize * 2, self.tilesize)
-
-        # calculate width of one tile to show below the ladder scale
-        d = distance(lat_a, lon_a, lat_b, lon_b) * (float(pixels) / self.tilesize)
-
-        dist = value_with_units(d)
-
         color = self.window.get_colormap().alloc_color("black")
         gc = self.window.new_gc(line_width=1, foreground=color)
 
@@ -730,13 +829,44 @@ class MapWidget(gtk.DrawingArea):
         self.window.draw_line(gc, x, y-shift, x, y-shift-tick)
         self.window.draw_line(gc, x-(pixels/2), y-shift, x-(pixels/2), y-shift-tick)
 
+        self.window.draw_layout(gc, x-pixels, y-shift,
+                                self.scale_layout(pixels))
+
+    def scale_layout(self, pixels=128):
+        # The scale text only depends on the map bounds and the display
+        # units, so the layout is rebuilt only when one of them changes
+        # rather than on every expose
+        key = (self.lat_min, self.lat_max, self.lon_min, self.lon_max,
+               self.tilesize, pixels, gps.EARTH_UNITS)
+        if self._scale_cache[0] == key:
+            return self._scale_cache[1]
+
+        (lat_a, lon_a) = self.xy2latlon(self.tilesize, self.tilesize)
+        (lat_b, lon_b) = self.xy2latlon(self.tilesize * 2, self.tilesize)
+
+        # calculate width of one tile to show below the ladder scale
+        d = distance(lat_a, lon_a, lat_b, lon_b) * (float(pixels) / self.tilesize)
+
+        dist = value_with_units(d)
+
         pl = self.create_pango_layout("")
         pl.set_markup("%s" % dist)
-        self.window.draw_layout(gc, x-pixels, y-shift, pl)
+
+        self._scale_cache = (key, pl)
+        return pl
 
     def point_is_visible(self, lat, lon):
-        for i in self.map_tiles:
-            if (lat, lon) in i:
+        # Most points are nowhere near the map, so check the overall
+        # bounds first.  Note that lon_max is the west edge and lon_min
+        # the east one, see calculate_bounds().
+        if not (self.lat_min <= lat <= self.lat_max and
+                self.lon_max <= lon <= self.lon_min):
+            return False
+
+        # Same test as MapTile.__contains__(), but against the edges
+        # cached by load_tiles() instead of recomputing them per tile
+        for (lat_max, lat_min, lon_min, lon_max) in self._tile_bounds:
+            if lat_min < lat < lat_max and lon_min < lon < lon_max:
                 return True
 
         return False
@@ -818,7 +948,7 @@ class MapWindow(gtk.Window):
             src.save()
             break
 
-        self.map.queue_draw()
+        self.map.schedule_redraw()
 
     def marker_mh(self, _action, id, group):
         action = _action.get_name()
@@ -1454,7 +1584,7 @@ class MapWindow(gtk.Window):
                 return self.add_point(source, point)
 
         self.add_point_visible(point)
-        self.map.queue_draw()
+        self.map.schedule_redraw()
 
     def add_point(self, source, point):
         (lat, lon) = self.map.get_center()
@@ -1468,7 +1598,7 @@ class MapWindow(gtk.Window):
                                   center.distance_from(this),
                                   center.bearing_to(this))
         self.add_point_visible(point)
-        self.map.queue_draw()
+        self.map.schedule_redraw()
 
     def del_point(self, source, point):
         self.marker_list.del_item(source.get_name(), point.get_name())
@@ -1476,7 +1606,7 @@ class MapWindow(gtk.Window):
         if point in self.points_visible:
             self.points_visible.remove(point)
 
-        self.map.queue_draw()
+        self.map.schedule_redraw()
 
     def get_map_source(self, name):
         for source in self.get_map_sources():
@@ -1502,7 +1632,7 @@ class MapWindow(gtk.Window):
             for point in src.get_points():
                 self.update_point(src, point)
 
-        self.map.queue_draw()
+        self.map.schedule_redraw()
 
     def maybe_recenter_on_updated_point(self, source, point):
         if point.get_name() == self.center_mark and \
@@ -1521,11 +1651,15 @@ class MapWindow(gtk.Window):
         return self.map_sources
 
     def redraw_markers(self, map):
-        for point in self.points_visible:
-            map.draw_marker(point.get_name(),
-                            point.get_latitude(),
-                            point.get_longitude(),
-                            point.get_icon())
+        try:
+            coords = map.latlons2xy([(point.get_latitude(),
+                                      point.get_longitude())
+                                     for point in self.points_visible])
+        except ZeroDivisionError:
+            return
+
+        for point, (x, y) in zip(self.points_visible, coords):
+            map.draw_marker_xy(point.get_name(), x, y, point.get_icon())
 
     def __init__(self, config, *args):
    #     gtk.Window.__init__(self, *args)
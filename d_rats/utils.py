@@ -44,9 +44,16 @@ def open_icon_map(iconfn):
 
 ICON_MAPS = None
 
+# Icons cut out of the APRS icon maps, by symbol.  The same few symbols
+# are asked for over and over (every station point, every icon chooser),
+# and the returned pixbufs are only ever displayed, so share them.
+ICON_CACHE = {}
+
 def init_icon_maps():
     global ICON_MAPS
 
+    ICON_CACHE.clear()
+
     ICON_MAPS = {
         "/" : open_icon_map(os.path.join(dplatform.get_platform().source_dir(),
                                          "images", "aprs_pri.png")),
@@ -183,6 +190,18 @@ def get_icon(key):
     if not key:
         return None
 
+    try:
+        return ICON_CACHE[key]
+    except KeyError:
+        pass
+
+    icon = _get_icon(key)
+    if icon is not None:
+        ICON_CACHE[key] = icon
+
+    return icon
+
+def _get_icon(key):
     if len(key) == 2:
         if key[0] == "/":
             set = "/"